@@ -0,0 +1,138 @@
+# Micro benchmark of the CPU time spent per row writing each stream
+'''
+Compares the CPU time per row of building a new insert().values(...) construct
+for every message (the previous write path) against building the row dicts with
+rows.py and writing them with one executemany of its cached insert statements.
+The prepare column is the row building alone, prepared is row building plus the
+insert. Both paths write to an in memory SQLite database, so the numbers include
+the SQLAlchemy statement / parameter handling but not network or MySQL time.
+
+Usage: python src/bench_rows.py [messages]
+'''
+import sys
+import time
+import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import null
+
+from storage import meta, table_orderbook, table_trades, table_ticker, table_ohlcv
+from rows import insert_orderbook, insert_trades, insert_ticker, insert_ohlcv
+from rows import orderbook_rows, trade_rows, ticker_rows, ohlcv_rows
+
+EXCHANGE = 'Bybit'
+SYMBOL = 'BTC/USD:BTC'
+TIMESTAMP = 1689312188717
+DATETIME = '2023-07-14T05:23:08.717Z'
+TRADES_PER_MESSAGE = 10
+
+
+def sample_messages() -> dict:
+    '''
+    One ccxt message per stream, shaped like the examples in ws_outputs.py.
+
+    :return: Dict of stream name to message.
+    '''
+    trade = {'info': {'T': TIMESTAMP, 's': 'BTCUSD', 'S': 'Buy', 'v': '100', 'p': '31387.00'},
+             'id': '12345-67890:09876/54321', 'timestamp': TIMESTAMP, 'datetime': DATETIME,
+             'symbol': SYMBOL, 'order': None, 'type': None, 'side': 'buy', 'takerOrMaker': 'taker',
+             'price': 31387.0, 'amount': 100.0, 'cost': 0.0031860, 'fee': None, 'fees': []}
+    ticker = {'ask': 31387.0, 'askVolume': 260928.0, 'average': 30843.0, 'baseVolume': 1109194605.0,
+              'bid': 31386.5, 'bidVolume': 452330.0, 'change': 1088.0, 'close': 31387.0,
+              'datetime': DATETIME, 'high': 31869.0, 'last': 31387.0, 'low': 30283.0,
+              'open': 30299.0, 'percentage': 3.5908, 'previousClose': None, 'quoteVolume': 35713.7539,
+              'symbol': SYMBOL, 'timestamp': TIMESTAMP, 'vwap': 3.2197915261226e-05,
+              'info': {'ask1Price': '31387.00', 'bid1Price': '31386.50', 'fundingRate': '0.0001',
+                       'markPrice': '31386.50', 'openInterest': '557635538'}}
+    orderbook = {'bids': [[31386.5 - i * 0.5, 1000.0 + i] for i in range(50)],
+                 'asks': [[31387.0 + i * 0.5, 1000.0 + i] for i in range(50)],
+                 'symbol': SYMBOL, 'timestamp': TIMESTAMP, 'datetime': DATETIME, 'nonce': 1499280391811}
+    candle = [[TIMESTAMP - TIMESTAMP % 60000, 31380.0, 31390.0, 31370.0, 31387.0, 37.72941911]]
+    return {'orderbook': orderbook,
+            'trades': [dict(trade, id=str(i)) for i in range(TRADES_PER_MESSAGE)],
+            'ticker': ticker,
+            'ohlcv': candle}
+
+
+def format_to_none(value):
+    if (value is None) or (value == 'null') or (value == []):
+        return null()
+    return value
+
+
+def write_values(conn, stream: str, message) -> None:
+    '''
+    Previous write path, a new insert().values(...) per row.
+    '''
+    if stream == 'orderbook':
+        conn.execute(table_orderbook.insert().values(
+            exchange=EXCHANGE, symbol=message['symbol'], asks=message['asks'], bids=message['bids'],
+            nonce=message['nonce'], date_time=datetime.datetime.fromisoformat(message['datetime']),
+            created_at=message['timestamp']))
+    elif stream == 'trades':
+        for trade in message:
+            conn.execute(table_trades.insert().values(
+                exchange=EXCHANGE, symbol=SYMBOL, trade_id=trade['id'], order_id=trade['order'],
+                order_type=trade['type'], trade_side=trade['side'], taker_maker=trade['takerOrMaker'],
+                executed_price=trade['price'], base_amount=trade['amount'], cost=trade['cost'],
+                fee=format_to_none(trade['fee']), fees=format_to_none(trade['fees']), info=trade['info'],
+                date_time=datetime.datetime.fromisoformat(trade['datetime']),
+                created_at=trade['timestamp']))
+    elif stream == 'ticker':
+        conn.execute(table_ticker.insert().values(
+            exchange=EXCHANGE, symbol=SYMBOL, ask=message['ask'], ask_volume=message['askVolume'],
+            bid=message['bid'], bid_volume=message['bidVolume'], open_24h=message['open'],
+            high_24h=message['high'], low_24h=message['low'], close_24h=message['close'],
+            last_price=message['last'], vwap=message['vwap'],
+            previous_close_price=message['previousClose'], price_change=message['change'],
+            percentage_change=message['percentage'], average_price=message['average'],
+            base_volume=message['baseVolume'], quote_volume=message['quoteVolume'],
+            info=message['info'], date_time=datetime.datetime.fromisoformat(message['datetime']),
+            created_at=message['timestamp']))
+    elif stream == 'ohlcv':
+        conn.execute(table_ohlcv.insert().values(
+            exchange=EXCHANGE, symbol=SYMBOL, open_price=message[0][1], high_price=message[0][2],
+            low_price=message[0][3], close_price=message[0][4], candle_volume=message[0][5],
+            created_at=message[0][0],
+            date_time=datetime.datetime.utcfromtimestamp(message[0][0] / 1000)))
+
+
+PREPARED = {'orderbook': (insert_orderbook, lambda message: orderbook_rows(EXCHANGE, message)),
+            'trades': (insert_trades, lambda message: trade_rows(EXCHANGE, SYMBOL, message)),
+            'ticker': (insert_ticker, lambda message: ticker_rows(EXCHANGE, SYMBOL, message)),
+            'ohlcv': (insert_ohlcv, lambda message: ohlcv_rows(EXCHANGE, SYMBOL, message))}
+
+
+def cpu_us_per_row(function, messages: int, rows_per_message: int) -> float:
+    start = time.process_time()
+    for _ in range(messages):
+        function()
+    return (time.process_time() - start) / (messages * rows_per_message) * 1e6
+
+
+def main(messages: int) -> None:
+    engine = create_engine('sqlite://')
+    meta.create_all(engine)
+    samples = sample_messages()
+
+    print(f'CPU microseconds per row, {messages} messages per stream')
+    print(f"{'stream':<10}{'values()':>12}{'prepare':>12}{'prepared':>12}{'speedup':>10}")
+    with engine.begin() as conn:
+        for stream, message in samples.items():
+            statement, prepare = PREPARED[stream]
+            rows_per_message = len(prepare(message))
+
+            # Warm up the compiled cache of both paths
+            write_values(conn, stream, message)
+            conn.execute(statement, prepare(message))
+
+            before = cpu_us_per_row(lambda: write_values(conn, stream, message),
+                                    messages, rows_per_message)
+            prepare_only = cpu_us_per_row(lambda: prepare(message), messages, rows_per_message)
+            after = cpu_us_per_row(lambda: conn.execute(statement, prepare(message)),
+                                   messages, rows_per_message)
+            print(f'{stream:<10}{before:>12.1f}{prepare_only:>12.1f}{after:>12.1f}{before / after:>9.1f}x')
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,205 @@
+# Lease based ownership of exchange / symbol pairs across scraper instances
+import os
+import random
+import socket
+import asyncio
+import datetime
+
+from typing import Awaitable, Callable, Union
+from sqlalchemy import select, update, insert, or_, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from storage import table_leases
+
+
+def now_ms() -> int:
+    return int(datetime.datetime.now(datetime.UTC).timestamp() * 1000)
+
+
+class LeaseManager:
+    '''
+    Coordinates several scraper instances writing to the same database.
+    Every exchange / symbol pair has a row in the leases table. An instance
+    owns a pair while its lease has not expired, and renews every lease it
+    holds on each heartbeat. A lease that is not renewed expires after the
+    ttl and is claimed by the next instance to heartbeat, so the streams
+    of a dead host are picked up by the others.
+
+    Claims are a single conditional UPDATE (or INSERT for a pair that has
+    no lease row yet), so they are atomic on both MySQL and SQLite.
+    Expiry is compared against each host's local clock, so clocks
+    should be synced and the ttl well above any skew between hosts.
+    '''
+    def __init__(self,
+                 session_factory: Callable[[], AsyncSession],
+                 owner: Union[str, None] = None,
+                 ttl_ms: int = 15000,
+                 heartbeat_ms: int = 5000,
+                 max_leases: Union[int, None] = None) -> None:
+
+        self.session_factory = session_factory
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl_ms = ttl_ms
+        self.heartbeat_ms = heartbeat_ms
+        self.max_leases = max_leases
+        self.tasks = {}  # (exchange, symbol) -> running stream task
+        self.expires = {}  # (exchange, symbol) -> local expiry of the last successful claim
+
+    async def claim(self, exchange: str, symbol: str) -> Union[int, None]:
+        '''
+        Claim or renew the lease of a pair. Succeeds if the pair has
+        no lease yet, the lease has expired, or it is already ours.
+
+        :param exchange: The exchange id.
+        :param symbol: The trading symbol.
+        :return: The expires_at written if this instance holds the lease, else None.
+        '''
+        now = now_ms()
+        expires_at = now + self.ttl_ms
+        async with self.session_factory() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(table_leases)
+                    .where(table_leases.c.exchange == exchange,
+                           table_leases.c.symbol == symbol,
+                           or_(table_leases.c.owner == self.owner,
+                               table_leases.c.expires_at < now))
+                    # acquired_at is assigned before owner, as MySQL evaluates the
+                    # assignments in order and the CASE has to see the previous owner
+                    .ordered_values((table_leases.c.acquired_at,
+                                     case((table_leases.c.owner == self.owner,
+                                           table_leases.c.acquired_at),
+                                          else_=now)),
+                                    (table_leases.c.owner, self.owner),
+                                    (table_leases.c.heartbeat_at, now),
+                                    (table_leases.c.expires_at, expires_at)))
+                if result.rowcount:
+                    return expires_at
+
+                # Held by another instance. Only a pair that was never claimed gets
+                # an INSERT, so standby instances do not fail one on every heartbeat
+                existing = await session.execute(
+                    select(table_leases.c.id)
+                    .where(table_leases.c.exchange == exchange,
+                           table_leases.c.symbol == symbol))
+                if existing.first() is not None:
+                    return None
+        try:
+            async with self.session_factory() as session:
+                async with session.begin():
+                    await session.execute(
+                        insert(table_leases).values(exchange=exchange,
+                                                    symbol=symbol,
+                                                    owner=self.owner,
+                                                    acquired_at=now,
+                                                    heartbeat_at=now,
+                                                    expires_at=expires_at))
+            return expires_at
+        except IntegrityError:
+            # Another instance inserted the lease row first
+            return None
+
+    async def release(self, exchange: str, symbol: str) -> None:
+        '''
+        Expire our lease on a pair so another instance can claim it right away.
+
+        :param exchange: The exchange id.
+        :param symbol: The trading symbol.
+        :return: None
+        '''
+        async with self.session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    update(table_leases)
+                    .where(table_leases.c.exchange == exchange,
+                           table_leases.c.symbol == symbol,
+                           table_leases.c.owner == self.owner)
+                    .values(expires_at=0))
+
+    async def stop(self, pair: tuple) -> None:
+        '''
+        Cancel the stream task of a pair we no longer own, and wait for it
+        to write its buffered rows.
+
+        :param pair: (exchange, symbol)
+        :return: None
+        '''
+        task = self.tasks.pop(pair, None)
+        self.expires.pop(pair, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        print(f'Lease lost for {pair[0]} {pair[1]}, stream stopped')
+
+    async def heartbeat(self, streams: dict) -> None:
+        '''
+        One coordination round: reap finished streams, renew held leases,
+        stop streams whose lease could not be renewed before expiring,
+        and claim free pairs up to max_leases.
+
+        :param streams: Dict of (exchange, symbol) to a callable returning the stream coroutine.
+        :return: None
+        '''
+        for pair, task in list(self.tasks.items()):
+            if task.done():
+                if not task.cancelled() and task.exception() is not None:
+                    print(f'Stream {pair[0]} {pair[1]} exited: {task.exception()}')
+                self.tasks.pop(pair)
+                self.expires.pop(pair, None)
+                try:
+                    await self.release(*pair)
+                except Exception as e:
+                    # The lease expires on its own after the ttl
+                    print(f'Failed to release lease for {pair[0]} {pair[1]}: {e}')
+
+        # Shuffled so instances with max_leases set do not all race for the same pairs
+        pairs = list(streams)
+        random.shuffle(pairs)
+        for pair in pairs:
+            owned = pair in self.tasks
+            if not owned and self.max_leases is not None and len(self.tasks) >= self.max_leases:
+                continue
+            try:
+                expires_at = await self.claim(*pair)
+            except Exception as e:
+                print(f'Lease heartbeat failed for {pair[0]} {pair[1]}: {e}')
+                # Keep streaming until our last successful claim would have expired
+                if owned and now_ms() >= self.expires[pair]:
+                    await self.stop(pair)
+                continue
+
+            if expires_at is not None:
+                self.expires[pair] = expires_at
+                if not owned:
+                    self.tasks[pair] = asyncio.create_task(streams[pair]())
+                    print(f'Lease acquired for {pair[0]} {pair[1]} by {self.owner}')
+            elif owned:
+                await self.stop(pair)
+
+    async def run(self, streams: dict[tuple[str, str], Callable[[], Awaitable]]) -> None:
+        '''
+        Heartbeat forever, running the streams of every pair we hold a lease on.
+        On exit every stream is cancelled, and its lease released once the
+        stream has written its buffered rows.
+
+        :param streams: Dict of (exchange, symbol) to a callable returning the stream coroutine.
+        :return: None
+        '''
+        print(f'Coordinating {len(streams)} streams as {self.owner}')
+        try:
+            while True:
+                await self.heartbeat(streams)
+                await asyncio.sleep(self.heartbeat_ms / 1000)
+        finally:
+            tasks = dict(self.tasks)
+            self.tasks.clear()
+            self.expires.clear()
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for pair in tasks:
+                try:
+                    await self.release(*pair)
+                except Exception as e:
+                    print(f'Failed to release lease for {pair[0]} {pair[1]}: {e}')
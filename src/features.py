@@ -0,0 +1,79 @@
+# Order book features computed at ingest
+from itertools import accumulate
+from typing import Callable, Union
+
+from storage import IMBALANCE_LEVELS, DEPTH_BANDS_BPS
+
+
+def compute_orderbook_features(bids: list,
+                               asks: list) -> Union[dict, None]:
+    '''
+    Compute top of book and depth features from a single order book update.
+    Bids are expected best (highest) first and asks best (lowest) first,
+    which is how ccxt returns them. Each side is walked once: cumulative
+    amounts are accumulated up front so every imbalance level and depth band
+    is a lookup instead of a rescan of the book.
+
+    :param bids: List of [price, amount] bid levels.
+    :param asks: List of [price, amount] ask levels.
+    :return: Dict keyed by orderbook_features column names,
+             or None if either side of the book is empty.
+    '''
+    if not bids or not asks:
+        return None
+
+    best_bid, bid_size = bids[0][0], bids[0][1]
+    best_ask, ask_size = asks[0][0], asks[0][1]
+    mid_price = (best_bid + best_ask) / 2
+    top_size = bid_size + ask_size
+
+    features = {
+        'best_bid': best_bid,
+        'best_ask': best_ask,
+        'bid_size': bid_size,
+        'ask_size': ask_size,
+        'spread': best_ask - best_bid,
+        'mid_price': mid_price,
+        # Size weighted mid, leans towards the side with less resting size
+        'microprice': ((best_bid * ask_size + best_ask * bid_size) / top_size
+                       if top_size else mid_price),
+    }
+
+    bid_cumulative = list(accumulate(level[1] for level in bids))
+    ask_cumulative = list(accumulate(level[1] for level in asks))
+
+    # Imbalance over the top N levels, in [-1, 1]. Positive means more bid depth.
+    for levels in IMBALANCE_LEVELS:
+        bid_depth = bid_cumulative[min(levels, len(bid_cumulative)) - 1]
+        ask_depth = ask_cumulative[min(levels, len(ask_cumulative)) - 1]
+        total = bid_depth + ask_depth
+        features[f'imbalance_{levels}'] = (bid_depth - ask_depth) / total if total else None
+
+    # Cumulative resting amount within each band of the mid price
+    for bps in DEPTH_BANDS_BPS:
+        offset = mid_price * bps / 10_000
+        features[f'bid_depth_{bps}bps'] = _depth_within(bids, bid_cumulative,
+                                                        lambda price: price >= mid_price - offset)
+        features[f'ask_depth_{bps}bps'] = _depth_within(asks, ask_cumulative,
+                                                        lambda price: price <= mid_price + offset)
+    return features
+
+
+def _depth_within(levels: list,
+                  cumulative: list,
+                  in_band: Callable[[float], bool]) -> float:
+    '''
+    Cumulative amount of the levels inside a band. Levels are sorted
+    best first, so the walk stops at the first level outside the band.
+
+    :param levels: List of [price, amount] levels, best first.
+    :param cumulative: Running sum of the level amounts.
+    :param in_band: Returns True if a price is inside the band.
+    :return: Total amount inside the band.
+    '''
+    count = 0
+    for level in levels:
+        if not in_band(level[0]):
+            break
+        count += 1
+    return cumulative[count - 1] if count else 0.0
@@ -0,0 +1,153 @@
+# Live fan out of the normalized streams to local consumers over a unix socket
+import os
+import json
+import stat
+import asyncio
+
+from typing import AsyncIterator
+
+
+class LiveFeed:
+    '''
+    Publishes every stream message to all local subscribers connected to a
+    unix socket, as newline delimited JSON:
+    {"stream": ..., "exchange": ..., "symbol": ..., "data": ...}
+
+    Each message is serialized once and the same bytes are queued for every
+    subscriber. Publishing never waits: each subscriber has a bounded queue
+    drained by its own writer task, and a subscriber whose queue is full is
+    disconnected rather than slowing down the watch loops.
+
+    A {pid} in the path is replaced by the process id, so several
+    instances on one host each get their own socket.
+    '''
+    def __init__(self, path: str, queue_size: int = 1000) -> None:
+
+        self.path = path.format(pid=os.getpid())
+        self.queue_size = queue_size
+        self.server = None
+        self.subscribers = {}  # StreamWriter -> asyncio.Queue
+        self.tasks = set()  # Subscriber writer tasks
+
+    async def start(self) -> None:
+        '''
+        Start listening on the unix socket. A socket file left behind by a
+        process that is gone is replaced, but a socket another process is
+        still listening on, or any other file at the path, is left alone.
+
+        :return: None
+        '''
+        if os.path.lexists(self.path):
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                raise FileExistsError(f'{self.path} exists and is not a socket')
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is listening, stale socket of a previous run
+                os.unlink(self.path)
+            else:
+                writer.close()
+                raise RuntimeError(f'Live feed {self.path} is in use by another process')
+        self.server = await asyncio.start_unix_server(self._handle_subscriber, path=self.path)
+        print(f'Live feed listening on {self.path}')
+
+    async def close(self) -> None:
+        '''
+        Disconnect every subscriber and stop the server.
+
+        :return: None
+        '''
+        for writer in list(self.subscribers):
+            self._drop(writer)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            if os.path.lexists(self.path):
+                os.unlink(self.path)
+
+    def publish(self, stream: str, exchange: str, symbol: str, data) -> None:
+        '''
+        Queue a message for every subscriber without waiting.
+        Nothing is serialized when no one is subscribed.
+
+        :param stream: Stream name, e.g. trades, orderbook, ticker, ohlcv.
+        :param exchange: The name of the exchange.
+        :param symbol: The trading symbol.
+        :param data: JSON serializable payload.
+        :return: None
+        '''
+        if not self.subscribers:
+            return
+        message = json.dumps({'stream': stream,
+                              'exchange': exchange,
+                              'symbol': symbol,
+                              'data': data},
+                             separators=(',', ':'), default=str).encode() + b'\n'
+        for writer, queue in list(self.subscribers.items()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                print('Live feed subscriber too slow, disconnected')
+                self._drop(writer)
+
+    def _drop(self, writer: asyncio.StreamWriter) -> None:
+        '''
+        Disconnect a subscriber and wake its writer task so it exits.
+
+        :param writer: The subscriber connection.
+        :return: None
+        '''
+        queue = self.subscribers.pop(writer, None)
+        if queue is not None and not queue.full():
+            queue.put_nowait(None)
+        writer.close()
+
+    async def _handle_subscriber(self,
+                                 reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> None:
+        '''
+        Writer task of a single subscriber, drains its queue onto the socket.
+
+        :param reader: Unused, subscribers only receive.
+        :param writer: The subscriber connection.
+        :return: None
+        '''
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[writer] = queue
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            while writer in self.subscribers:
+                message = await queue.get()
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.subscribers.pop(writer, None)
+            self.tasks.discard(task)
+            writer.close()
+
+
+async def subscribe(path: str) -> AsyncIterator[dict]:
+    '''
+    Consume a live feed from another process.
+
+        async for message in subscribe('/tmp/crypto_feed.sock'):
+            if message['stream'] == 'trades': ...
+
+    :param path: Path of the live feed unix socket.
+    :return: Async iterator of decoded messages.
+    '''
+    reader, writer = await asyncio.open_unix_connection(path, limit=2**24)
+    try:
+        while line := await reader.readline():
+            yield json.loads(line)
+    finally:
+        writer.close()
@@ -2,16 +2,23 @@ import sys
 import ccxt.pro
 import asyncio
 import datetime
+import functools
 
 from typing import List, Callable, Union
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import null
 
-from storage import meta, table_ohlcv, table_orderbook
-from storage import table_trades, table_ticker, table_logs
+from storage import meta, table_logs, table_orderbook_features
 from helpers import load_config
+from features import compute_orderbook_features
+from writers import BatchWriter
+from rows import insert_orderbook, insert_trades, insert_ticker, insert_ohlcv, insert_rows
+from rows import orderbook_rows, trade_rows, ticker_rows, ohlcv_rows, ms_to_datetime
+from rollups import TradeRollup, TickerRollup
+from coordination import LeaseManager
+from live_feed import LiveFeed
+from supervision import StreamHealth, EXCHANGE_ERROR, PROCESSING_ERROR, STORAGE_ERROR, report_health
 
 print('Python version: ', sys.version_info)
 print('Sys executable: ', sys.executable)
@@ -101,26 +108,61 @@ class LogRateLimiter:
             self.last_log_time = now_ms
             print('Error is logged')
             
-def format_to_none(value):
+async def handle_stream_error(error: Exception,
+                              source: str,
+                              health: StreamHealth,
+                              session_factory: Callable[[], AsyncSession],
+                              log_rate_limiter: LogRateLimiter) -> None:
     '''
-    Convert ccxt json nulls into proper sqlalchemy nulls.
-    
-    :param value: The value to be checked if null
-    :return: value or sqlalchemy null
+    Record a failed watch loop iteration with its stream supervisor,
+    which schedules the next attempt, and log the error to the database.
+    While the storage circuit is open the database is known to be failing,
+    so the error is only printed. Failing to write the log never raises,
+    so the watch loop keeps running.
+
+    :param error: The exception raised.
+    :param source: EXCHANGE_ERROR, PROCESSING_ERROR or STORAGE_ERROR
+    :param health: Supervisor of the stream that failed.
+    :param session_factory: Generates AsyncSession for database operations.
+    :param log_rate_limiter: Database logger
+    :return: None
     '''
-    if (value is None) or (value == 'null') or (value == []):
-        return null()
-    return value
+    health.record_failure(source, error)
+    error_type = error.__class__.__name__
+    created_at = int(datetime.datetime.now(datetime.UTC).timestamp()*1000)
+    print(f'{health.exchange} {health.symbol} {health.stream} {source} error, '
+          f'{health.state}, retrying in {health.retry_in():.1f}s')
+    print('Type: ', error_type)
+    print('Error: ', error)
+
+    if health.breakers[STORAGE_ERROR].is_open:
+        return
+    try:
+        await log_rate_limiter.write_logs(session_factory=session_factory,
+                                          exchange=health.exchange,
+                                          symbol=health.symbol,
+                                          error_type=error_type,
+                                          message=str(error),
+                                          stream=health.stream,
+                                          created_at=created_at)
+    except Exception as e:
+        print('Failed to log error: ', e)
 
 async def watch_order_book(exchange: ccxt.pro.Exchange,
                            symbol: str,
                            orderbook_depth: int,
                            session_factory: Callable[[], AsyncSession],
-                           log_rate_limiter: LogRateLimiter) -> None:
+                           log_rate_limiter: LogRateLimiter,
+                           feature_writer: Union[BatchWriter, None] = None,
+                           live_feed: Union[LiveFeed, None] = None,
+                           health: Union[StreamHealth, None] = None) -> None:
     '''
     Continously watch the orderbook for a
     specific symbol / exchange pair
     and update its table with the new realtime info.
+    If a feature writer is given, top of book / depth features
+    are computed for every update and written in batches
+    to the orderbook_features table.
 
     :param exchange: The exchange object
     :param symbol: The specific trading symbol to watch
@@ -128,106 +170,125 @@ async def watch_order_book(exchange: ccxt.pro.Exchange,
     :param session_factory: Generates AsyncSession for database
            operations.
     :param log_rate_limiter: Database logger
+    :param feature_writer: Optional batch writer for orderbook features
+    :param live_feed: Optional live feed the orderbook is published to
+    :param health: Supervisor handling backoff / circuit breaking, a default one is used if None
     :return: None
     '''
     name = getattr(exchange, 'name')
     orderbook = None
+    if health is None:
+        health = StreamHealth(name, symbol, 'watch_order_book')
     
     while True:
+        await health.wait()
         try:
-            orderbook = await exchange.watch_order_book(symbol, orderbook_depth)
+            orderbook = await health.watch(exchange, lambda: exchange.watch_order_book(symbol, orderbook_depth))
+        except Exception as e:
+            await handle_stream_error(e, EXCHANGE_ERROR, health, session_factory, log_rate_limiter)
+            continue
+        health.heartbeat()
 
+        try:
+            if live_feed is not None:
+                live_feed.publish('orderbook', name, symbol,
+                                  {'bids': orderbook['bids'],
+                                   'asks': orderbook['asks'],
+                                   'nonce': orderbook['nonce'],
+                                   'timestamp': orderbook['timestamp']})
+            rows = orderbook_rows(name, orderbook)
+
+            if feature_writer is not None:
+                features = compute_orderbook_features(orderbook['bids'], orderbook['asks'])
+                if features is not None:
+                    feature_writer.add({'exchange': name,
+                                        'symbol': orderbook['symbol'],
+                                        **features,
+                                        'date_time': ms_to_datetime(orderbook['timestamp']),
+                                        'created_at': orderbook['timestamp']})
+        except Exception as e:
+            await handle_stream_error(e, PROCESSING_ERROR, health, session_factory, log_rate_limiter)
+            continue
+
+        try:
             async with session_factory() as session:
                 async with session.begin():
-                    await session.execute(
-                        table_orderbook.insert().values(
-                            exchange=name,
-                            symbol=orderbook['symbol'],
-                            asks=orderbook['asks'],
-                            bids=orderbook['bids'],
-                            nonce=orderbook['nonce'],
-                            date_time=datetime.datetime.fromisoformat(
-                                orderbook['datetime']),
-                            created_at=orderbook['timestamp']))
+                    await insert_rows(session, insert_orderbook, rows)
 
-        except Exception as e:
-            error_type = e.__class__.__name__
-            message = str(e)
-            
-            created_at = int(datetime.datetime.now(datetime.UTC).timestamp()*1000)
-            print('Type: ', error_type)
-            print('Error: ', e)
+            # Features are written in their own transaction once the raw row is committed,
+            # so a failure in the derived table never costs raw data
+            if feature_writer is not None and feature_writer.ready():
+                await feature_writer.write(session_factory)
 
-            await log_rate_limiter.write_logs(session_factory=session_factory,
-                                              exchange=exchange.name,
-                                              symbol=symbol,
-                                              error_type=error_type,
-                                              message=message,
-                                              stream="watch_order_book",
-                                              created_at=created_at)
+            health.record_success()
+        except Exception as e:
+            await handle_stream_error(e, STORAGE_ERROR, health, session_factory, log_rate_limiter)
 
 
 async def watch_trades(exchange: ccxt.pro.Exchange,
                        symbol: str,
                        session_factory: Callable[[], AsyncSession],
-                       log_rate_limiter: LogRateLimiter) -> None:
+                       log_rate_limiter: LogRateLimiter,
+                       rollup: Union[TradeRollup, None] = None,
+                       live_feed: Union[LiveFeed, None] = None,
+                       health: Union[StreamHealth, None] = None) -> None:
     '''
     Continously watch the trades for a specific symbol / exchange pair
     and update its table with the new realtime info.
+    If a rollup is given, every committed trade is also folded into it and
+    finished buckets are written in a separate transaction.
 
     :param exchange: The exchange object
     :param symbol: The specific trading symbol to watch
     :param session_factory: Generates AsyncSession for database
            operations.
     :param log_rate_limiter: Database logger
+    :param rollup: Optional trades rollup
+    :param live_feed: Optional live feed the trades are published to
+    :param health: Supervisor handling backoff / circuit breaking, a default one is used if None
     :return: None
     '''
     name = getattr(exchange, 'name')
     trades = None
+    if health is None:
+        health = StreamHealth(name, symbol, 'watch_trades')
     while True:
+        await health.wait()
         try:
-            trades = await exchange.watch_trades(symbol)
+            trades = await health.watch(exchange, lambda: exchange.watch_trades(symbol))
+        except Exception as e:
+            await handle_stream_error(e, EXCHANGE_ERROR, health, session_factory, log_rate_limiter)
+            continue
+        health.heartbeat()
+
+        try:
+            if live_feed is not None:
+                live_feed.publish('trades', name, symbol, trades)
+
+            rows = trade_rows(name, symbol, trades)
 
+            if rollup is not None:
+                rollup_values = [(trade['timestamp'], trade['price'], trade['amount'],
+                                  trade['cost'], trade['side'])
+                                 for trade in trades]
+        except Exception as e:
+            await handle_stream_error(e, PROCESSING_ERROR, health, session_factory, log_rate_limiter)
+            continue
+
+        try:
             async with session_factory() as session:
                 async with session.begin():
-                    
-                    for trade in trades:
-                        fee = format_to_none(trade['fee'])
-                        fees = format_to_none(trade['fees'])
-                        
-                        await session.execute(
-                            table_trades.insert().values(
-                                exchange=name,
-                                symbol=symbol,
-                                trade_id=trade['id'],
-                                order_id=trade['order'],
-                                order_type=trade['type'],
-                                trade_side=trade['side'],
-                                taker_maker=trade['takerOrMaker'],
-                                executed_price=trade['price'],
-                                base_amount=trade['amount'],
-                                cost=trade['cost'],
-                                fee=fee,
-                                fees=fees,
-                                info=trade['info'],                                
-                                date_time=datetime.datetime.fromisoformat(
-                                    trade['datetime']),
-                                created_at=trade['timestamp']))
+                    await insert_rows(session, insert_trades, rows)
+
+            # Trades are only folded into the rollup once they are committed, so the
+            # rollup always matches the raw table. Buckets are written in their own transaction.
+            if rollup is not None:
+                for values in rollup_values:
+                    rollup.add(name, symbol, *values)
+                await rollup.write(session_factory)
+            health.record_success()
         except Exception as e:
-            error_type = e.__class__.__name__
-            message = str(e)
-            
-            created_at = int(datetime.datetime.now(datetime.UTC).timestamp()*1000)
-            print('Type: ', error_type)
-            print('Error: ', e)
-
-            await log_rate_limiter.write_logs(session_factory=session_factory,
-                                              exchange=exchange.name,
-                                              symbol=symbol,
-                                              error_type=error_type,
-                                              message=message,
-                                              stream="watch_trades",
-                                              created_at=created_at)
+            await handle_stream_error(e, STORAGE_ERROR, health, session_factory, log_rate_limiter)
 
 
 async def watch_ohlcv(exchange: ccxt.pro.Exchange,
@@ -235,12 +296,15 @@ async def watch_ohlcv(exchange: ccxt.pro.Exchange,
                       timeframe: str,
                       candle_limit: int,
                       session_factory: Callable[[], AsyncSession],
-                      log_rate_limiter: LogRateLimiter) -> None:
+                      log_rate_limiter: LogRateLimiter,
+                      live_feed: Union[LiveFeed, None] = None,
+                      health: Union[StreamHealth, None] = None) -> None:
     '''
     Continously watch the ticker for a specific symbol / exchange pair
     and update its table with the new realtime info.
     OHLCV stream does not push unique / only new data,
-    so it is cached and checked.
+    so it is cached and checked. The live feed gets every update,
+    including the still forming candle.
 
     :param exchange: The exchange object
     :param symbol: The specific trading symbol to watch
@@ -249,117 +313,112 @@ async def watch_ohlcv(exchange: ccxt.pro.Exchange,
     :param session_factory: Generates AsyncSession for database
            operations.
     :param log_rate_limiter: Database logger
+    :param live_feed: Optional live feed the candles are published to
+    :param health: Supervisor handling backoff / circuit breaking, a default one is used if None
     :return: None
     '''
     last_candle = None
     candle = None
     name = getattr(exchange, 'name')
+    if health is None:
+        health = StreamHealth(name, symbol, 'watch_ohlcv')
 
     while True:
+        await health.wait()
         try:
-            candle = await exchange.watch_ohlcv(symbol, timeframe, None, candle_limit)
+            candle = await health.watch(exchange, lambda: exchange.watch_ohlcv(symbol, timeframe, None, candle_limit))
+        except Exception as e:
+            await handle_stream_error(e, EXCHANGE_ERROR, health, session_factory, log_rate_limiter)
+            continue
+        health.heartbeat()
 
-            async with session_factory() as session:
-                async with session.begin():
-                    if last_candle is None:
-                        last_candle = candle
-
-                    #if timestamps are not equal
-                    if last_candle[0][0] != candle[0][0]:
-
-                        await session.execute(
-                            table_ohlcv.insert().values(
-                                exchange=name,
-                                symbol=symbol,
-                                open_price=last_candle[0][1],
-                                high_price=last_candle[0][2],
-                                low_price=last_candle[0][3],
-                                close_price=last_candle[0][4],
-                                candle_volume=last_candle[0][5],
-                                created_at=last_candle[0][0],
-                                date_time=datetime.datetime.utcfromtimestamp(
-                                    last_candle[0][0]/1000)))
-                    last_candle = candle
+        try:
+            if live_feed is not None:
+                live_feed.publish('ohlcv', name, symbol, candle)
+
+            if last_candle is None:
+                last_candle = candle
+
+            #if timestamps are not equal, the last candle is closed
+            rows = None
+            if last_candle[0][0] != candle[0][0]:
+                rows = ohlcv_rows(name, symbol, last_candle[:1])
         except Exception as e:
-            error_type = e.__class__.__name__
-            message = str(e)
-            
-            created_at = int(datetime.datetime.now(datetime.UTC).timestamp()*1000)
-            print('Type: ', error_type)
-            print('Error: ', e)
-       
-
-            await log_rate_limiter.write_logs(session_factory=session_factory,
-                                              exchange=exchange.name,
-                                              symbol=symbol,
-                                              error_type=error_type,
-                                              message=message,
-                                              stream="watch_ohlcv",
-                                              created_at=created_at)
+            await handle_stream_error(e, PROCESSING_ERROR, health, session_factory, log_rate_limiter)
+            continue
+
+        try:
+            if rows:
+                async with session_factory() as session:
+                    async with session.begin():
+                        await insert_rows(session, insert_ohlcv, rows)
+            last_candle = candle
+            health.record_success()
+        except Exception as e:
+            await handle_stream_error(e, STORAGE_ERROR, health, session_factory, log_rate_limiter)
 
 async def watch_ticker(exchange: ccxt.pro.Exchange,
                        symbol: str,
                        session_factory: Callable[[], AsyncSession],
-                       log_rate_limiter: LogRateLimiter) -> None:
+                       log_rate_limiter: LogRateLimiter,
+                       rollup: Union[TickerRollup, None] = None,
+                       live_feed: Union[LiveFeed, None] = None,
+                       health: Union[StreamHealth, None] = None) -> None:
     '''
     Continously watch the ticker for a specific symbol / exchange pair
     and update its table with the new realtime info.
+    If a rollup is given, every committed ticker is also folded into it and
+    finished buckets are written in a separate transaction.
 
     :param exchange: The exchange object
     :param symbol: The specific trading symbol to watch
     :param session_factory: Generates AsyncSession for database
     operations.
     :param log_rate_limiter: Database logger
+    :param rollup: Optional ticker rollup
+    :param live_feed: Optional live feed the ticker is published to
+    :param health: Supervisor handling backoff / circuit breaking, a default one is used if None
     :return: None
     '''
     name = getattr(exchange, 'name')
+    if health is None:
+        health = StreamHealth(name, symbol, 'watch_ticker')
 
     while True:
+        await health.wait()
         try:
-            ticker = await exchange.watch_ticker(symbol)
+            ticker = await health.watch(exchange, lambda: exchange.watch_ticker(symbol))
+        except Exception as e:
+            await handle_stream_error(e, EXCHANGE_ERROR, health, session_factory, log_rate_limiter)
+            continue
+        health.heartbeat()
+
+        try:
+            if live_feed is not None:
+                live_feed.publish('ticker', name, symbol, ticker)
+
+            rows = ticker_rows(name, symbol, ticker)
+
+            if rollup is not None:
+                rollup_values = (ticker['timestamp'], ticker['last'], ticker['bid'], ticker['ask'])
+        except Exception as e:
+            await handle_stream_error(e, PROCESSING_ERROR, health, session_factory, log_rate_limiter)
+            continue
 
+        try:
             async with session_factory() as session:
                 async with session.begin():
-                    await session.execute(
-                        table_ticker.insert().values(
-                            exchange=name,
-                            symbol=symbol,
-                            ask=ticker['ask'],
-                            ask_volume=ticker['askVolume'],
-                            bid=ticker['bid'],
-                            bid_volume=ticker['bidVolume'],
-                            open_24h=ticker['open'],
-                            high_24h=ticker['high'],
-                            low_24h=ticker['low'],
-                            close_24h=ticker['close'],
-                            last_price=ticker['last'],
-                            vwap=ticker['vwap'],
-                            previous_close_price=ticker['previousClose'],
-                            price_change=ticker['change'],
-                            percentage_change=ticker['percentage'],
-                            average_price=ticker['average'],
-                            base_volume=ticker['baseVolume'],
-                            quote_volume=ticker['quoteVolume'],
-                            info=ticker['info'],
-                            date_time=datetime.datetime.fromisoformat(ticker['datetime']),
-                            created_at=ticker['timestamp'])) # When the response was generated
+                    await insert_rows(session, insert_ticker, rows)
+
+            # The ticker is only folded into the rollup once it is committed, so the
+            # rollup always matches the raw table. Buckets are written in their own transaction.
+            if rollup is not None:
+                rollup.add(name, symbol, *rollup_values)
+                await rollup.write(session_factory)
 
+            health.record_success()
         except Exception as e:
-            error_type = e.__class__.__name__
-            message = str(e)
-            
-            created_at = int(datetime.datetime.now(datetime.UTC).timestamp()*1000)
-            print('Type: ', error_type)
-            print('Error: ', e)
-       
-
-            await log_rate_limiter.write_logs(session_factory=session_factory,
-                                              exchange=exchange.name,
-                                              symbol=symbol,
-                                              error_type=error_type,
-                                              message=message,
-                                              stream="watch_ticker",
-                                              created_at=created_at)            
+            await handle_stream_error(e, STORAGE_ERROR, health, session_factory, log_rate_limiter)
 
 async def watch_market_data(exchange: ccxt.pro.Exchange,
                             symbol: str,
@@ -367,12 +426,21 @@ async def watch_market_data(exchange: ccxt.pro.Exchange,
                             timeframe: str,
                             candle_limit: int,
                             orderbook_depth: int,
-                            log_rate_limiters: dict) -> None:
+                            log_rate_limiters: dict,
+                            orderbook_features: bool = False,
+                            feature_batch_size: int = 100,
+                            rollup_intervals_ms: Union[list, None] = None,
+                            live_feed: Union[LiveFeed, None] = None,
+                            healths: Union[dict, None] = None,
+                            supervision: Union[dict, None] = None) -> None:
     '''
     Watch websocket streams for a specific symbol / exchange pair.
     Starts concurrent tasks for streaming OHLCV, ticker updates,
     trades, and order book snapshots. Each stream is fetched
     and inserted asynchronously. Each stream gets its own rate limiter.
+    Orderbook features get their own batch writer per symbol when enabled,
+    as do the trades / ticker rollups. Every stream is supervised by its own
+    StreamHealth, registered in healths while the stream runs.
 
     :param exchange: The exchange object to watch the market data on.
     :param symbol: The trading symbol to watch.
@@ -381,56 +449,104 @@ async def watch_market_data(exchange: ccxt.pro.Exchange,
     :param candle_limit: The number of candles to fetch for OHLCV data.
     :param orderbook_depth: The depth of the order book to maintain.
     :param log_rate_limiters: Dict of log rate limiters, every stream gets its own
+    :param orderbook_features: Compute and store orderbook features at ingest
+    :param feature_batch_size: Number of feature rows written per insert
+    :param rollup_intervals_ms: Rollup bucket lengths in milliseconds, None disables rollups
+    :param live_feed: Optional live feed every stream is published to
+    :param healths: Dict of (exchange, symbol, stream) to StreamHealth the supervisors are registered in
+    :param supervision: Keyword arguments for every StreamHealth, e.g. base_delay_s
     :return: None
     '''
+    if healths is None:
+        healths = {}
+    name = getattr(exchange, 'name')
+
+    def supervisor(stream: str) -> StreamHealth:
+        health = StreamHealth(name, symbol, stream, **(supervision or {}))
+        healths[(name, symbol, stream)] = health
+        return health
 
     loops = []
+    ticker_rollup = trade_rollup = feature_writer = None
     if exchange.has["watchOHLCV"]:
         loops.append(
-            watch_ohlcv(exchange, symbol, timeframe, candle_limit, session_factory, log_rate_limiters["ohlcv"]))
+            watch_ohlcv(exchange, symbol, timeframe, candle_limit, session_factory, log_rate_limiters["ohlcv"],
+                        live_feed, supervisor('watch_ohlcv')))
     if exchange.has["watchTicker"]:
+        if rollup_intervals_ms:
+            ticker_rollup = TickerRollup(intervals_ms=rollup_intervals_ms)
         loops.append(
-            watch_ticker(exchange, symbol, session_factory, log_rate_limiters["ticker"]))
+            watch_ticker(exchange, symbol, session_factory, log_rate_limiters["ticker"], ticker_rollup,
+                         live_feed, supervisor('watch_ticker')))
     if exchange.has["watchTrades"]:
+        if rollup_intervals_ms:
+            trade_rollup = TradeRollup(intervals_ms=rollup_intervals_ms)
         loops.append(
-            watch_trades(exchange, symbol, session_factory, log_rate_limiters["trades"]))
+            watch_trades(exchange, symbol, session_factory, log_rate_limiters["trades"], trade_rollup,
+                         live_feed, supervisor('watch_trades')))
     if exchange.has["watchOrderBook"]:
+        if orderbook_features:
+            feature_writer = BatchWriter(table_orderbook_features, batch_size=feature_batch_size)
         loops.append(
-            watch_order_book(exchange, symbol, orderbook_depth, session_factory, log_rate_limiters["order_book"]))
-
-    await asyncio.gather(*loops)
-
-
-async def database_setup(user: str,
-                         password: str,
-                         host: str,
-                         port: int,
-                         db_name: str) -> sessionmaker:
+            watch_order_book(exchange, symbol, orderbook_depth, session_factory, log_rate_limiters["order_book"],
+                             feature_writer, live_feed, supervisor('watch_order_book')))
+
+    try:
+        await asyncio.gather(*loops)
+    finally:
+        # Streams stopped, e.g. when a lease is lost, no longer report health
+        for stream in ['watch_ohlcv', 'watch_ticker', 'watch_trades', 'watch_order_book']:
+            healths.pop((name, symbol, stream), None)
+
+        # Write buffered feature rows and open rollup buckets before the lease is released
+        for rollup in (ticker_rollup, trade_rollup):
+            if rollup is not None:
+                try:
+                    await rollup.write(session_factory, force=True)
+                except Exception as e:
+                    print(f'Failed to write {rollup.table.name} for {name} {symbol}: {e}')
+        if feature_writer is not None:
+            try:
+                await feature_writer.write(session_factory)
+            except Exception as e:
+                print(f'Failed to write orderbook features for {name} {symbol}: {e}')
+
+
+async def database_setup(user: Union[str, None] = None,
+                         password: Union[str, None] = None,
+                         host: Union[str, None] = None,
+                         port: Union[int, None] = None,
+                         db_name: Union[str, None] = None,
+                         url: Union[str, None] = None) -> sessionmaker:
     '''
     Creates a database if it doesn't exists using a temporary engine,
     connects to the database and creates an asynchronous session.
     Tables are created and asynchronous session factory is returned.
     Expire on commit set to false for efficency.
-    Uses aiomysql connector.
+    Uses aiomysql connector, unless a full database url is given
+    (e.g. sqlite+aiosqlite:///crypto.db for local testing), in which
+    case the database is connected to as is.
 
     :param user: The database username.
     :param password: The database password.
     :param host: The host.
     :param port: The database port number.
     :param db_name: Name of the database to be created / connected to.
+    :param url: Optional SQLAlchemy database url, overrides the MySQL settings.
     :return: An asynchronous session factory for performing database operations.
     '''
 
-    # Create temporary engine to create database
-    temp_url = f'mysql+aiomysql://{user}:{password}@{host}:{port}/'
-    temp_engine = create_async_engine(temp_url, echo=True)
-    async with temp_engine.begin() as conn:
-        await conn.execute(text(f"CREATE DATABASE IF NOT EXISTS {db_name}"))
-    await temp_engine.dispose()
+    if url is None:
+        # Create temporary engine to create database
+        temp_url = f'mysql+aiomysql://{user}:{password}@{host}:{port}/'
+        temp_engine = create_async_engine(temp_url, echo=True)
+        async with temp_engine.begin() as conn:
+            await conn.execute(text(f"CREATE DATABASE IF NOT EXISTS {db_name}"))
+        await temp_engine.dispose()
+        url = f'{temp_url}{db_name}'
 
     # Connect to database
-    engine_url = f'{temp_url}{db_name}'
-    engine = create_async_engine(engine_url, echo=True)
+    engine = create_async_engine(url, echo=True)
 
     # Create async db session factory
     async_session_factory = sessionmaker(engine,
@@ -488,16 +604,34 @@ async def main():
     
     config = await load_config()
 
-    async_session_factory = await database_setup(user=config['credentials']['user'],
-                                                 password=config['credentials']['password'],
-                                                 host=config['credentials']['host'],
-                                                 port=config['credentials']['port'],
-                                                 db_name=config['credentials']['db_name'])
+    async_session_factory = await database_setup(user=config['credentials'].get('user'),
+                                                 password=config['credentials'].get('password'),
+                                                 host=config['credentials'].get('host'),
+                                                 port=config['credentials'].get('port'),
+                                                 db_name=config['credentials'].get('db_name'),
+                                                 url=config['credentials'].get('url'))
+    # Start the live feed before any stream publishes to it
+    live_feed = None
+    if config.get('live_feed', {}).get('enabled', False):
+        live_feed = LiveFeed(path=config['live_feed']['path'],
+                             queue_size=config['live_feed'].get('queue_size', 1000))
+        try:
+            await live_feed.start()
+        except (OSError, RuntimeError) as e:
+            print(f'Live feed disabled: {e}')
+            live_feed = None
+
+    # Stream supervision, see StreamHealth for the settings
+    supervision = dict(config.get('supervision', {}))
+    report_interval_s = supervision.pop('report_interval_s', 60)
+    healths = {}
+    health_reporter = asyncio.create_task(report_health(healths, report_interval_s, live_feed))
+
     # Initialize exchange
     exchange_objects = await initialize_exchanges(exchange_names=config['exchanges'].keys())
 
-    # Load markets and create tasks
-    tasks = []
+    # Load markets and create a stream per exchange / symbol pair
+    streams = {}
     for exchange_id, exchange in exchange_objects.items():
         try:
             markets = await exchange.load_markets()
@@ -507,21 +641,48 @@ async def main():
             timeframe = config['settings']['timeframe']
             candle_limit = config['settings']['candle_limit']
             orderbook_depth = config['settings']['orderbook_depth']       
+            orderbook_features = config['settings'].get('orderbook_features', False)
+            feature_batch_size = config['settings'].get('feature_batch_size', 100)
+            rollup_intervals_ms = None
+            if config['settings'].get('rollups', False):
+                rollup_intervals_ms = config['settings'].get('rollup_intervals_ms', [1000, 60000])
             
             for symbol in symbols:
-                task = watch_market_data(exchange=exchange,
-                                         symbol=symbol,
-                                         session_factory=async_session_factory,
-                                         timeframe=timeframe,
-                                         candle_limit=candle_limit,
-                                         orderbook_depth=orderbook_depth,
-                                         log_rate_limiters=limiters)
-                tasks.append(task)
+                streams[(exchange_id, symbol)] = functools.partial(
+                    watch_market_data,
+                    exchange=exchange,
+                    symbol=symbol,
+                    session_factory=async_session_factory,
+                    timeframe=timeframe,
+                    candle_limit=candle_limit,
+                    orderbook_depth=orderbook_depth,
+                    log_rate_limiters=limiters,
+                    orderbook_features=orderbook_features,
+                    feature_batch_size=feature_batch_size,
+                    rollup_intervals_ms=rollup_intervals_ms,
+                    live_feed=live_feed,
+                    healths=healths,
+                    supervision=supervision)
 
         except Exception as e:
             print(f"{str(e)}")
 
-    await asyncio.gather(*tasks, return_exceptions=False)
+    # With coordination enabled, only pairs this instance holds a lease on are streamed
+    coordination = config.get('coordination', {})
+    try:
+        if coordination.get('enabled', False):
+            lease_manager = LeaseManager(session_factory=async_session_factory,
+                                         owner=coordination.get('owner'),
+                                         ttl_ms=coordination.get('lease_ttl_ms', 15000),
+                                         heartbeat_ms=coordination.get('heartbeat_ms', 5000),
+                                         max_leases=coordination.get('max_leases'))
+            await lease_manager.run(streams)
+        else:
+            await asyncio.gather(*(stream() for stream in streams.values()), return_exceptions=False)
+    finally:
+        health_reporter.cancel()
+        if live_feed is not None:
+            await live_feed.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
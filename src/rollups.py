@@ -0,0 +1,371 @@
+# Continuous per bucket aggregates of the trades and ticker streams
+import datetime
+from abc import ABC, abstractmethod
+from typing import Callable, Union
+
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from storage import table_trades, table_ticker
+from storage import table_trades_rollup, table_ticker_rollup
+from writers import BatchWriter
+
+
+def bucket_datetime(bucket_start: int) -> datetime.datetime:
+    '''
+    Naive UTC datetime of a bucket start, matching the other date_time columns.
+
+    :param bucket_start: Bucket start in milliseconds.
+    :return: datetime
+    '''
+    return datetime.datetime.fromtimestamp(bucket_start / 1000, datetime.UTC).replace(tzinfo=None)
+
+
+class Rollup(ABC):
+    '''
+    Base class for incrementally maintained rollups.
+    Rows are folded into an open bucket per exchange / symbol / interval
+    as they arrive. A bucket is closed once the newest timestamp seen for
+    its exchange / symbol is past the end of the bucket plus a grace period,
+    at which point it is handed to a batch writer for its rollup table.
+
+    Rows that arrive after their bucket was closed open a new bucket for the
+    same period, so the rollup table can hold more than one partial row for a
+    bucket. Counts and volumes of those rows can be summed, and rebuild_rollups
+    collapses them back to a single row.
+
+    Subclasses implement new_state, merge and to_row for their stream.
+    '''
+    table = None
+
+    def __init__(self,
+                 intervals_ms: tuple = (1000, 60000),
+                 grace_ms: int = 2000,
+                 batch_size: int = 100,
+                 max_delay_ms: int = 1000) -> None:
+
+        self.intervals_ms = tuple(intervals_ms)
+        self.grace_ms = grace_ms
+        self.buckets = {}  # (exchange, symbol, interval_ms, bucket_start) -> bucket state
+        self.watermarks = {}  # (exchange, symbol) -> newest timestamp seen
+        self.writer = BatchWriter(self.table, batch_size=batch_size, max_delay_ms=max_delay_ms)
+
+    def _update(self, exchange: str, symbol: str, timestamp: int, *values) -> None:
+        '''
+        Fold a row into the open bucket of every interval.
+
+        :param exchange: The name of the exchange.
+        :param symbol: The trading symbol.
+        :param timestamp: Row timestamp in milliseconds.
+        :param values: Stream specific values passed to new_state / merge.
+        :return: None
+        '''
+        for interval_ms in self.intervals_ms:
+            key = (exchange, symbol, interval_ms, timestamp - timestamp % interval_ms)
+            state = self.buckets.get(key)
+            if state is None:
+                self.buckets[key] = self.new_state(timestamp, *values)
+            else:
+                self.merge(state, timestamp, *values)
+
+        watermark = self.watermarks.get((exchange, symbol))
+        if watermark is None or timestamp > watermark:
+            self.watermarks[(exchange, symbol)] = timestamp
+
+    def close_buckets(self, force: bool = False) -> None:
+        '''
+        Move every bucket past its end plus the grace period to the writer.
+
+        :param force: Close every open bucket regardless of the watermark.
+        :return: None
+        '''
+        for key in list(self.buckets):
+            exchange, symbol, interval_ms, bucket_start = key
+            if force or bucket_start + interval_ms + self.grace_ms <= self.watermarks[(exchange, symbol)]:
+                state = self.buckets.pop(key)
+                row = self.to_row(state)
+                row.update(exchange=exchange,
+                           symbol=symbol,
+                           interval_ms=interval_ms,
+                           date_time=bucket_datetime(bucket_start),
+                           created_at=bucket_start)
+                self.writer.add(row)
+
+    async def flush(self, session: AsyncSession, force: bool = False) -> None:
+        '''
+        Close finished buckets and write them inside the callers transaction
+        once a batch is ready.
+
+        :param session: AsyncSession with an open transaction.
+        :param force: Close and write every open bucket now.
+        :return: None
+        '''
+        self.close_buckets(force=force)
+        if force or self.writer.ready():
+            await self.writer.flush(session)
+
+    async def write(self,
+                    session_factory: Callable[[], AsyncSession],
+                    force: bool = False) -> None:
+        '''
+        Close finished buckets and write them in their own transaction
+        once a batch is ready. Used by the watch loops, so a failing rollup
+        write never rolls back the raw rows.
+
+        :param session_factory: Generates AsyncSession for database operations.
+        :param force: Close and write every open bucket now.
+        :return: None
+        '''
+        self.close_buckets(force=force)
+        if force or self.writer.ready():
+            await self.writer.write(session_factory)
+
+    @abstractmethod
+    def new_state(self, timestamp: int, *values) -> list:
+        '''
+        State of a new bucket from its first row.
+        '''
+
+    @abstractmethod
+    def merge(self, state: list, timestamp: int, *values) -> None:
+        '''
+        Fold a row into the state of an open bucket.
+        '''
+
+    @abstractmethod
+    def to_row(self, state: list) -> dict:
+        '''
+        Stream specific columns of a closed bucket.
+        '''
+
+
+class TradeRollup(Rollup):
+    '''
+    OHLC, VWAP, trade count and buy / sell volume per bucket.
+
+    Volumes are in the units ccxt reports: amount is base currency on spot
+    markets but contracts on derivatives, and cost is not price * amount
+    for contracts (inverse markets report it in the base currency). The VWAP
+    is therefore weighted by amount over its own sum of price * amount,
+    and cost is only used for quote_volume.
+    '''
+    table = table_trades_rollup
+
+    def add(self,
+            exchange: str,
+            symbol: str,
+            timestamp: int,
+            price: float,
+            amount: float,
+            cost: Union[float, None],
+            side: Union[str, None]) -> None:
+        '''
+        Add a single trade.
+
+        :param exchange: The name of the exchange.
+        :param symbol: The trading symbol.
+        :param timestamp: Trade timestamp in milliseconds.
+        :param price: Executed price.
+        :param amount: Amount of base currency, or contracts.
+        :param cost: ccxt trade cost, price * amount if missing.
+        :param side: 'buy' or 'sell'.
+        :return: None
+        '''
+        if timestamp is None or price is None or amount is None:
+            return
+        if cost is None:
+            cost = price * amount
+        self._update(exchange, symbol, timestamp, price, amount, cost, side)
+
+    def new_state(self, timestamp, price, amount, cost, side) -> list:
+        # first_ts, last_ts, open, high, low, close, count, base, quote, buy, sell, price * amount
+        return [timestamp, timestamp, price, price, price, price, 1, amount, cost,
+                amount if side == 'buy' else 0.0,
+                amount if side == 'sell' else 0.0,
+                price * amount]
+
+    def merge(self, state, timestamp, price, amount, cost, side) -> None:
+        if timestamp < state[0]:
+            state[0] = timestamp
+            state[2] = price
+        if timestamp >= state[1]:
+            state[1] = timestamp
+            state[5] = price
+        if price > state[3]:
+            state[3] = price
+        if price < state[4]:
+            state[4] = price
+        state[6] += 1
+        state[7] += amount
+        state[8] += cost
+        if side == 'buy':
+            state[9] += amount
+        elif side == 'sell':
+            state[10] += amount
+        state[11] += price * amount
+
+    def to_row(self, state) -> dict:
+        return {'open_price': state[2],
+                'high_price': state[3],
+                'low_price': state[4],
+                'close_price': state[5],
+                'vwap': state[11] / state[7] if state[7] else None,
+                'trade_count': state[6],
+                'base_volume': state[7],
+                'quote_volume': state[8],
+                'buy_volume': state[9],
+                'sell_volume': state[10]}
+
+
+class TickerRollup(Rollup):
+    '''
+    Last ticker and number of ticker updates per bucket.
+    '''
+    table = table_ticker_rollup
+
+    def add(self,
+            exchange: str,
+            symbol: str,
+            timestamp: int,
+            last_price: Union[float, None],
+            bid: Union[float, None],
+            ask: Union[float, None]) -> None:
+        '''
+        Add a single ticker update.
+
+        :param exchange: The name of the exchange.
+        :param symbol: The trading symbol.
+        :param timestamp: Ticker timestamp in milliseconds.
+        :param last_price: Last traded price.
+        :param bid: Best bid.
+        :param ask: Best ask.
+        :return: None
+        '''
+        if timestamp is None:
+            return
+        self._update(exchange, symbol, timestamp, last_price, bid, ask)
+
+    def new_state(self, timestamp, last_price, bid, ask) -> list:
+        # last_update, last_price, bid, ask, count
+        return [timestamp, last_price, bid, ask, 1]
+
+    def merge(self, state, timestamp, last_price, bid, ask) -> None:
+        if timestamp >= state[0]:
+            state[0:4] = [timestamp, last_price, bid, ask]
+        state[4] += 1
+
+    def to_row(self, state) -> dict:
+        return {'last_update': state[0],
+                'last_price': state[1],
+                'bid': state[2],
+                'ask': state[3],
+                'update_count': state[4]}
+
+
+async def rebuild_rollups(session_factory: Callable[[], AsyncSession],
+                          exchange: str,
+                          symbol: str,
+                          start_ms: int,
+                          end_ms: int,
+                          intervals_ms: tuple = (1000, 60000),
+                          chunk_ms: int = 3_600_000) -> None:
+    '''
+    Rebuild the trades and ticker rollups of an exchange / symbol from the raw
+    tables for a time range. The range is widened to whole buckets of the largest
+    interval, then processed in chunks: for each chunk the existing rollup rows
+    are deleted and recomputed from the raw rows in a single transaction.
+
+    :param session_factory: A callable that returns an AsyncSession object for database operations.
+    :param exchange: The name of the exchange, as stored in the raw tables.
+    :param symbol: The trading symbol.
+    :param start_ms: Start of the range in milliseconds, inclusive.
+    :param end_ms: End of the range in milliseconds, exclusive.
+    :param intervals_ms: Bucket lengths to rebuild.
+    :param chunk_ms: Length of each chunk, rounded up to whole buckets.
+    :return: None
+    '''
+    largest = max(intervals_ms)
+    start_ms -= start_ms % largest
+    end_ms += -end_ms % largest
+    chunk_ms += -chunk_ms % largest
+
+    for chunk_start in range(start_ms, end_ms, chunk_ms):
+        chunk_end = min(chunk_start + chunk_ms, end_ms)
+        trade_rollup = TradeRollup(intervals_ms=intervals_ms, grace_ms=0)
+        ticker_rollup = TickerRollup(intervals_ms=intervals_ms, grace_ms=0)
+
+        async with session_factory() as session:
+            async with session.begin():
+                for rollup in (trade_rollup, ticker_rollup):
+                    await session.execute(
+                        delete(rollup.table).where(
+                            rollup.table.c.exchange == exchange,
+                            rollup.table.c.symbol == symbol,
+                            rollup.table.c.interval_ms.in_(intervals_ms),
+                            rollup.table.c.created_at >= chunk_start,
+                            rollup.table.c.created_at < chunk_end))
+
+                trades = await session.execute(
+                    select(table_trades.c.created_at,
+                           table_trades.c.executed_price,
+                           table_trades.c.base_amount,
+                           table_trades.c.cost,
+                           table_trades.c.trade_side)
+                    .where(table_trades.c.exchange == exchange,
+                           table_trades.c.symbol == symbol,
+                           table_trades.c.created_at >= chunk_start,
+                           table_trades.c.created_at < chunk_end)
+                    .order_by(table_trades.c.created_at))
+                for row in trades:
+                    trade_rollup.add(exchange, symbol, *row)
+
+                tickers = await session.execute(
+                    select(table_ticker.c.created_at,
+                           table_ticker.c.last_price,
+                           table_ticker.c.bid,
+                           table_ticker.c.ask)
+                    .where(table_ticker.c.exchange == exchange,
+                           table_ticker.c.symbol == symbol,
+                           table_ticker.c.created_at >= chunk_start,
+                           table_ticker.c.created_at < chunk_end)
+                    .order_by(table_ticker.c.created_at))
+                for row in tickers:
+                    ticker_rollup.add(exchange, symbol, *row)
+
+                await trade_rollup.flush(session, force=True)
+                await ticker_rollup.flush(session, force=True)
+        print(f'Rebuilt rollups for {exchange} {symbol} '
+              f'{bucket_datetime(chunk_start)} - {bucket_datetime(chunk_end)}')
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from helpers import load_config
+    from main import database_setup
+
+    parser = argparse.ArgumentParser(description='Rebuild trades / ticker rollups from the raw tables.')
+    parser.add_argument('exchange', help='Exchange name as stored in the raw tables, e.g. Binance')
+    parser.add_argument('symbol', help='Trading symbol, e.g. BTC/USD:BTC')
+    parser.add_argument('start', help='Start of the range, ISO8601 UTC, e.g. 2024-05-01T00:00:00')
+    parser.add_argument('end', help='End of the range, ISO8601 UTC')
+    args = parser.parse_args()
+
+    def to_ms(value: str) -> int:
+        parsed = datetime.datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.UTC)
+        return int(parsed.timestamp() * 1000)
+
+    async def rebuild():
+        config = await load_config()
+        session_factory = await database_setup(**config['credentials'])
+        await rebuild_rollups(session_factory=session_factory,
+                              exchange=args.exchange,
+                              symbol=args.symbol,
+                              start_ms=to_ms(args.start),
+                              end_ms=to_ms(args.end),
+                              intervals_ms=tuple(config['settings'].get('rollup_intervals_ms', (1000, 60000))))
+
+    asyncio.run(rebuild())
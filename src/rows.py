@@ -0,0 +1,157 @@
+# Row preparation for the raw stream tables
+import datetime
+from typing import Union
+
+from sqlalchemy import Insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from storage import table_orderbook, table_trades, table_ticker, table_ohlcv
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def ms_to_datetime(timestamp: Union[int, None]) -> Union[datetime.datetime, None]:
+    '''
+    Naive UTC datetime from a millisecond timestamp. Cheaper than parsing
+    the ccxt ISO8601 datetime string, and gives the same value.
+
+    :param timestamp: Unix timestamp in milliseconds.
+    :return: datetime, or None if there is no timestamp.
+    '''
+    if timestamp is None:
+        return None
+    return EPOCH + datetime.timedelta(milliseconds=timestamp)
+
+
+def json_or_none(value):
+    '''
+    Convert ccxt json nulls into None, stored as SQL NULL
+    by JSON columns with none_as_null set.
+
+    :param value: The value to be checked if null
+    :return: value or None
+    '''
+    if (value is None) or (value == 'null') or (value == []):
+        return None
+    return value
+
+
+# Insert statements are built once, so SQLAlchemy compiles each of them once
+# and serves it from its compiled cache for every message afterwards
+insert_orderbook = table_orderbook.insert()
+insert_trades = table_trades.insert()
+insert_ticker = table_ticker.insert()
+insert_ohlcv = table_ohlcv.insert()
+
+
+async def insert_rows(session: AsyncSession, statement: Insert, rows: list[dict]) -> None:
+    '''
+    Write rows with a single executemany inside the callers transaction.
+    Nothing is executed for an empty list, which would insert a row of defaults.
+
+    :param session: AsyncSession with an open transaction.
+    :param statement: One of the insert statements above.
+    :param rows: Dicts of column name to value.
+    :return: None
+    '''
+    if rows:
+        await session.execute(statement, rows)
+
+
+def orderbook_rows(exchange: str, orderbook: dict) -> list[dict]:
+    '''
+    Orderbook row, asks / bids are stored as is.
+
+    :param exchange: The name of the exchange.
+    :param orderbook: ccxt order book.
+    :return: Rows for insert_orderbook.
+    '''
+    timestamp = orderbook['timestamp']
+    return [{'exchange': exchange,
+             'symbol': orderbook['symbol'],
+             'asks': orderbook['asks'],
+             'bids': orderbook['bids'],
+             'nonce': orderbook['nonce'],
+             'date_time': ms_to_datetime(timestamp),
+             'created_at': timestamp}]
+
+
+def trade_rows(exchange: str, symbol: str, trades: list[dict]) -> list[dict]:
+    '''
+    Trade rows, one per trade in the message.
+
+    :param exchange: The name of the exchange.
+    :param symbol: The trading symbol.
+    :param trades: ccxt trades.
+    :return: Rows for insert_trades.
+    '''
+    return [{'exchange': exchange,
+             'symbol': symbol,
+             'trade_id': trade['id'],
+             'order_id': trade['order'],
+             'order_type': trade['type'],
+             'trade_side': trade['side'],
+             'taker_maker': trade['takerOrMaker'],
+             'executed_price': trade['price'],
+             'base_amount': trade['amount'],
+             'cost': trade['cost'],
+             'fee': json_or_none(trade['fee']),
+             'fees': json_or_none(trade['fees']),
+             'info': trade['info'],
+             'date_time': ms_to_datetime(trade['timestamp']),
+             'created_at': trade['timestamp']}
+            for trade in trades]
+
+
+def ticker_rows(exchange: str, symbol: str, ticker: dict) -> list[dict]:
+    '''
+    Ticker row.
+
+    :param exchange: The name of the exchange.
+    :param symbol: The trading symbol.
+    :param ticker: ccxt ticker.
+    :return: Rows for insert_ticker.
+    '''
+    timestamp = ticker['timestamp']
+    return [{'exchange': exchange,
+             'symbol': symbol,
+             'ask': ticker['ask'],
+             'ask_volume': ticker['askVolume'],
+             'bid': ticker['bid'],
+             'bid_volume': ticker['bidVolume'],
+             'open_24h': ticker['open'],
+             'high_24h': ticker['high'],
+             'low_24h': ticker['low'],
+             'close_24h': ticker['close'],
+             'last_price': ticker['last'],
+             'vwap': ticker['vwap'],
+             'previous_close_price': ticker['previousClose'],
+             'price_change': ticker['change'],
+             'percentage_change': ticker['percentage'],
+             'average_price': ticker['average'],
+             'base_volume': ticker['baseVolume'],
+             'quote_volume': ticker['quoteVolume'],
+             'info': ticker['info'],
+             'date_time': ms_to_datetime(timestamp),
+             'created_at': timestamp}]
+
+
+def ohlcv_rows(exchange: str, symbol: str, candles: list[list]) -> list[dict]:
+    '''
+    OHLCV rows, one per candle.
+
+    :param exchange: The name of the exchange.
+    :param symbol: The trading symbol.
+    :param candles: ccxt candles, [timestamp, open, high, low, close, volume].
+    :return: Rows for insert_ohlcv.
+    '''
+    return [{'exchange': exchange,
+             'symbol': symbol,
+             'open_price': candle[1],
+             'high_price': candle[2],
+             'low_price': candle[3],
+             'close_price': candle[4],
+             'candle_volume': candle[5],
+             'date_time': ms_to_datetime(candle[0]),
+             'created_at': candle[0]}
+            for candle in candles]
@@ -1,5 +1,6 @@
 #datastorage
 from sqlalchemy import Table, Column, Integer, String, MetaData, JSON, REAL, DATETIME, BigInteger
+from sqlalchemy import UniqueConstraint
 meta = MetaData()
 
 table_orderbook = Table(
@@ -61,8 +62,8 @@ table_trades = Table(
     Column('executed_price', REAL),
     Column('base_amount', REAL),
     Column('cost', REAL),
-    Column('fee', JSON),
-    Column('fees', JSON),
+    Column('fee', JSON(none_as_null = True)),
+    Column('fees', JSON(none_as_null = True)),
     Column('info', JSON), #original ticker data from exchange
     
    
@@ -106,3 +107,91 @@ table_logs = Table(
     Column('date_time', DATETIME, index = True),
     Column('created_at', BigInteger, index = True)
     )
+
+# Levels (top N of each side) the order book imbalance is computed over,
+# and the bands around the mid price (in basis points) cumulative depth is summed within
+IMBALANCE_LEVELS = (1, 5, 10, 25)
+DEPTH_BANDS_BPS = (5, 10, 25, 50, 100)
+
+table_orderbook_features = Table(
+    'orderbook_features',
+    meta,
+    Column('id', Integer, primary_key = True),
+    Column('exchange', String(32), index = True),
+    Column('symbol', String(16), index = True),
+
+    Column('best_bid', REAL),
+    Column('best_ask', REAL),
+    Column('bid_size', REAL),
+    Column('ask_size', REAL),
+    Column('spread', REAL),
+    Column('mid_price', REAL),
+    Column('microprice', REAL),
+    *[Column(f'imbalance_{levels}', REAL) for levels in IMBALANCE_LEVELS],
+    *[Column(f'bid_depth_{bps}bps', REAL) for bps in DEPTH_BANDS_BPS],
+    *[Column(f'ask_depth_{bps}bps', REAL) for bps in DEPTH_BANDS_BPS],
+
+    Column('date_time', DATETIME, index = True),
+    Column('created_at', BigInteger, index = True)
+    )
+
+# Continuous aggregates of the trades / ticker streams, one row per exchange, symbol and bucket.
+# created_at is the bucket start in milliseconds, interval_ms the bucket length.
+table_trades_rollup = Table(
+    'trades_rollup',
+    meta,
+    Column('id', Integer, primary_key = True),
+    Column('exchange', String(32), index = True),
+    Column('symbol', String(16), index = True),
+    Column('interval_ms', Integer, index = True),
+
+    Column('open_price', REAL),
+    Column('high_price', REAL),
+    Column('low_price', REAL),
+    Column('close_price', REAL),
+    Column('vwap', REAL),
+    Column('trade_count', Integer),
+    Column('base_volume', REAL),
+    Column('quote_volume', REAL),
+    Column('buy_volume', REAL),
+    Column('sell_volume', REAL),
+
+    Column('date_time', DATETIME, index = True),
+    Column('created_at', BigInteger, index = True)
+    )
+
+table_ticker_rollup = Table(
+    'ticker_rollup',
+    meta,
+    Column('id', Integer, primary_key = True),
+    Column('exchange', String(32), index = True),
+    Column('symbol', String(16), index = True),
+    Column('interval_ms', Integer, index = True),
+
+    # Values of the last ticker received in the bucket
+    Column('last_price', REAL),
+    Column('bid', REAL),
+    Column('ask', REAL),
+    Column('last_update', BigInteger),
+    Column('update_count', Integer),
+
+    Column('date_time', DATETIME, index = True),
+    Column('created_at', BigInteger, index = True)
+    )
+
+# Ownership of exchange / symbol pairs when several scraper instances share a database.
+# An instance owns a pair while expires_at (milliseconds) is in the future and keeps it by heartbeating.
+table_leases = Table(
+    'leases',
+    meta,
+    Column('id', Integer, primary_key = True),
+    Column('exchange', String(32), index = True),
+    Column('symbol', String(16), index = True),
+
+    Column('owner', String(128), index = True),
+    Column('acquired_at', BigInteger),
+    Column('heartbeat_at', BigInteger),
+    Column('expires_at', BigInteger, index = True),
+
+    UniqueConstraint('exchange', 'symbol')
+    )
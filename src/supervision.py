@@ -0,0 +1,302 @@
+# Backoff, circuit breaking and health tracking for the watch loops
+import time
+import random
+import asyncio
+
+from typing import Awaitable, Callable, Union
+from ccxt.base.errors import NetworkError
+
+# Where an error in a watch loop came from. Exchange errors are raised while
+# waiting on the websocket, processing errors while turning the message into
+# rows (malformed payloads), storage errors while writing the rows.
+EXCHANGE_ERROR = 'exchange'
+PROCESSING_ERROR = 'processing'
+STORAGE_ERROR = 'storage'
+
+# Stream health states
+STARTING = 'starting'
+HEALTHY = 'healthy'
+BACKOFF = 'backoff'
+OPEN = 'open'
+
+
+class CircuitBreaker:
+    '''
+    Counts consecutive failures of one error source. After failure_threshold
+    failures in a row the breaker opens and no attempt should be made until the
+    reset timeout has passed. The next attempt after that is a trial: success
+    closes the breaker, failure opens it again with the reset timeout doubled,
+    up to max_reset_timeout_s.
+    '''
+    def __init__(self,
+                 failure_threshold: int = 5,
+                 reset_timeout_s: float = 60,
+                 max_reset_timeout_s: float = 600) -> None:
+
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout_s = reset_timeout_s
+        self.reset_timeout_s = reset_timeout_s
+        self.max_reset_timeout_s = max_reset_timeout_s
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def record_success(self) -> None:
+        '''
+        Close the breaker and reset the failure count.
+
+        :return: None
+        '''
+        self.failures = 0
+        self.opened_at = None
+        self.reset_timeout_s = self.base_reset_timeout_s
+
+    def record_failure(self) -> None:
+        '''
+        Count a failure, opening the breaker at the threshold.
+
+        :return: None
+        '''
+        self.failures += 1
+        if self.is_open:
+            # Trial attempt after the reset timeout failed
+            self.reset_timeout_s = min(self.reset_timeout_s * 2, self.max_reset_timeout_s)
+            self.opened_at = time.monotonic()
+        elif self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def remaining(self) -> float:
+        '''
+        Seconds until the next attempt is allowed, 0 if the breaker is closed.
+
+        :return: float
+        '''
+        if not self.is_open:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout_s - time.monotonic())
+
+
+class StaleStreamError(NetworkError):
+    '''
+    Raised into every watch_* call waiting on a websocket connection that was
+    closed because one of its streams went stale.
+    '''
+
+
+def reconnect(exchange, symbol: str) -> int:
+    '''
+    Force the websocket connections carrying a symbol to reconnect.
+    ccxt keeps a connection and its subscriptions open until it errors, so
+    calling watch_* again on a silent connection only waits on it again.
+    Erroring the connection drops it from exchange.clients, and the next
+    watch_* call opens a new one and subscribes again.
+
+    Connections are matched by the symbol or market id appearing in their
+    subscriptions. If none match, every connection of the exchange is reset.
+
+    :param exchange: ccxt.pro exchange the stream belongs to.
+    :param symbol: The trading symbol of the stale stream.
+    :return: Number of connections reset.
+    '''
+    keys = {symbol.lower()}
+    try:
+        keys.add(exchange.market(symbol)['id'].lower())
+    except Exception:
+        pass
+
+    clients = list(exchange.clients.values())
+    matched = [client for client in clients
+               if any(key in str(subscription).lower()
+                      for subscription in list(client.subscriptions)
+                      for key in keys)]
+    for client in matched or clients:
+        try:
+            client.on_error(StaleStreamError(f'{symbol} stream stale, reconnecting'))
+        except Exception as e:
+            print(f'Failed to reset {client.url}: {e}')
+    return len(matched or clients)
+
+
+class StreamHealth:
+    '''
+    Supervises a single watch loop (one exchange / symbol / stream).
+    Exchange, processing and storage errors each have their own circuit breaker, and every
+    failure schedules the next attempt with exponential backoff and jitter
+    based on the consecutive failures of its source, so a persistent error
+    such as a delisted symbol or a dead database slows the loop down instead
+    of retrying at full speed.
+
+    Each message received from the exchange is a heartbeat. The first heartbeat
+    after an exchange error counts as a reconnect. A stream that has not
+    delivered anything within stale_timeout_s has its connection reset and is
+    watched again right away. Staleness is counted on its own and does not
+    touch the breakers or the backoff, so a quiet market is not an error.
+    '''
+    def __init__(self,
+                 exchange: str,
+                 symbol: str,
+                 stream: str,
+                 base_delay_s: float = 1,
+                 max_delay_s: float = 60,
+                 failure_threshold: int = 5,
+                 reset_timeout_s: float = 60,
+                 stale_timeout_s: Union[float, None] = None) -> None:
+
+        self.exchange = exchange
+        self.symbol = symbol
+        self.stream = stream
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.stale_timeout_s = stale_timeout_s
+        self.breakers = {EXCHANGE_ERROR: CircuitBreaker(failure_threshold, reset_timeout_s),
+                         PROCESSING_ERROR: CircuitBreaker(failure_threshold, reset_timeout_s),
+                         STORAGE_ERROR: CircuitBreaker(failure_threshold, reset_timeout_s)}
+
+        self.state = STARTING
+        self.retry_at = 0.0
+        self.disconnected = False
+        self.heartbeats = 0
+        self.last_heartbeat = None
+        self.reconnects = 0
+        self.stale_reconnects = 0
+        self.last_error = None
+
+    def retry_in(self) -> float:
+        '''
+        Seconds until the next attempt, the longer of the backoff and any open breaker.
+
+        :return: float
+        '''
+        backoff = max(0.0, self.retry_at - time.monotonic())
+        return max(backoff, *(breaker.remaining() for breaker in self.breakers.values()))
+
+    async def wait(self) -> None:
+        '''
+        Sleep until the stream is allowed to try again.
+
+        :return: None
+        '''
+        delay = self.retry_in()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def watch(self, exchange, watch: Callable[[], Awaitable]):
+        '''
+        Await a watch_* call. If nothing arrives within stale_timeout_s the
+        connection of the stream is reset and the call is made again, which
+        subscribes on a new connection. Other streams sharing that connection
+        see a StaleStreamError and are watched again the same way.
+
+        :param exchange: ccxt.pro exchange the stream belongs to.
+        :param watch: Returns a new exchange watch_* coroutine on every call.
+        :return: Its result.
+        '''
+        while True:
+            try:
+                if self.stale_timeout_s is None:
+                    return await watch()
+                return await asyncio.wait_for(watch(), self.stale_timeout_s)
+            except asyncio.TimeoutError:
+                self.stale_reconnects += 1
+                self.disconnected = True
+                resets = reconnect(exchange, self.symbol)
+                print(f'{self.exchange} {self.symbol} {self.stream} no update for '
+                      f'{self.stale_timeout_s}s, reset {resets} connection(s)')
+            except StaleStreamError:
+                # Connection reset because another stream on it went stale
+                self.disconnected = True
+
+    def heartbeat(self) -> None:
+        '''
+        Record a message received from the exchange.
+
+        :return: None
+        '''
+        self.heartbeats += 1
+        self.last_heartbeat = time.monotonic()
+        self.breakers[EXCHANGE_ERROR].record_success()
+        if self.disconnected:
+            self.disconnected = False
+            self.reconnects += 1
+            print(f'{self.exchange} {self.symbol} {self.stream} reconnected')
+
+    def record_success(self) -> None:
+        '''
+        Record a message that was processed and stored.
+
+        :return: None
+        '''
+        self.breakers[PROCESSING_ERROR].record_success()
+        self.breakers[STORAGE_ERROR].record_success()
+        self.state = HEALTHY
+
+    def record_failure(self, source: str, error: Exception) -> None:
+        '''
+        Record a failure and schedule the next attempt.
+
+        :param source: EXCHANGE_ERROR, PROCESSING_ERROR or STORAGE_ERROR
+        :param error: The exception raised.
+        :return: None
+        '''
+        breaker = self.breakers[source]
+        breaker.record_failure()
+        if source == EXCHANGE_ERROR:
+            self.disconnected = True
+        self.last_error = f'{source}: {error.__class__.__name__}: {error}'
+
+        delay = min(self.max_delay_s, self.base_delay_s * 2 ** min(breaker.failures - 1, 16))
+        self.retry_at = time.monotonic() + random.uniform(delay / 2, delay)
+        self.state = OPEN if breaker.is_open else BACKOFF
+
+    def snapshot(self) -> dict:
+        '''
+        Current health of the stream.
+
+        :return: Dict of health fields.
+        '''
+        return {'exchange': self.exchange,
+                'symbol': self.symbol,
+                'stream': self.stream,
+                'state': self.state,
+                'heartbeats': self.heartbeats,
+                'seconds_since_heartbeat': (None if self.last_heartbeat is None
+                                            else round(time.monotonic() - self.last_heartbeat, 3)),
+                'reconnects': self.reconnects,
+                'stale_reconnects': self.stale_reconnects,
+                'exchange_failures': self.breakers[EXCHANGE_ERROR].failures,
+                'processing_failures': self.breakers[PROCESSING_ERROR].failures,
+                'storage_failures': self.breakers[STORAGE_ERROR].failures,
+                'retry_in': round(self.retry_in(), 3),
+                'last_error': self.last_error}
+
+
+async def report_health(healths: dict,
+                        interval_s: float = 60,
+                        live_feed=None) -> None:
+    '''
+    Periodically print a summary of stream health, with a line for every
+    stream that is not healthy, and publish the full snapshot to the live feed.
+
+    :param healths: Dict of (exchange, symbol, stream) to StreamHealth, kept up to date by the streams.
+    :param interval_s: Seconds between reports.
+    :param live_feed: Optional live feed the snapshots are published to.
+    :return: None
+    '''
+    while True:
+        await asyncio.sleep(interval_s)
+        snapshots = [health.snapshot() for health in list(healths.values())]
+        counts = {}
+        for snapshot in snapshots:
+            counts[snapshot['state']] = counts.get(snapshot['state'], 0) + 1
+        print('Stream health: ' + ', '.join(f'{count} {state}' for state, count in sorted(counts.items())))
+        for snapshot in snapshots:
+            if snapshot['state'] != HEALTHY:
+                print(f"  {snapshot['exchange']} {snapshot['symbol']} {snapshot['stream']}: "
+                      f"{snapshot['state']}, retry in {snapshot['retry_in']}s, "
+                      f"reconnects {snapshot['reconnects']}, stale reconnects {snapshot['stale_reconnects']}, "
+                      f"last error {snapshot['last_error']}")
+        if live_feed is not None:
+            live_feed.publish('health', None, None, snapshots)
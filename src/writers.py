@@ -0,0 +1,118 @@
+# Batched table writers
+import time
+
+from typing import Callable, Union
+from sqlalchemy import Table
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class BatchWriter:
+    '''
+    Buffers rows for a single table and writes them with one
+    executemany insert once the batch is full, or the oldest
+    buffered row has waited longer than the max delay.
+    The insert statement is built once and reused for every flush.
+    Rows of a batch that fails to write are put back in the buffer to be
+    retried, keeping at most max_buffered rows so a database that stays
+    down cannot grow the buffer without bound.
+    '''
+    def __init__(self,
+                 table: Table,
+                 batch_size: int = 100,
+                 max_delay_ms: int = 1000,
+                 max_buffered: Union[int, None] = None) -> None:
+
+        self.statement = table.insert()
+        self.batch_size = batch_size
+        self.max_delay_ms = max_delay_ms
+        self.max_buffered = max_buffered or batch_size * 10
+        self.rows = []
+        self.first_row_time = None
+
+    def add(self, row: dict) -> None:
+        '''
+        Buffer a row to be written on the next flush.
+
+        :param row: Dict of column name to value.
+        :return: None
+        '''
+        if self.first_row_time is None:
+            self.first_row_time = time.monotonic()
+        self.rows.append(row)
+
+    def ready(self) -> bool:
+        '''
+        Whether the buffer should be flushed.
+
+        :return: True if the batch is full or the oldest row is overdue.
+        '''
+        if not self.rows:
+            return False
+        if len(self.rows) >= self.batch_size:
+            return True
+        return (time.monotonic() - self.first_row_time) * 1000 >= self.max_delay_ms
+
+    def take(self) -> list[dict]:
+        '''
+        Remove and return every buffered row.
+
+        :return: The buffered rows, oldest first.
+        '''
+        rows = self.rows
+        self.rows = []
+        self.first_row_time = None
+        return rows
+
+    def restore(self, rows: list[dict]) -> None:
+        '''
+        Put rows of a failed write back in front of the buffer,
+        dropping the oldest rows beyond max_buffered.
+
+        :param rows: The rows returned by take.
+        :return: None
+        '''
+        self.rows = rows + self.rows
+        if len(self.rows) > self.max_buffered:
+            dropped = len(self.rows) - self.max_buffered
+            self.rows = self.rows[dropped:]
+            print(f'{self.statement.table.name} buffer full, dropped {dropped} rows')
+        if self.rows:
+            self.first_row_time = time.monotonic()
+
+    async def flush(self, session: AsyncSession) -> None:
+        '''
+        Write all buffered rows inside the callers transaction.
+        If the insert fails the rows are restored to the buffer,
+        the caller is responsible for the rest of its transaction.
+
+        :param session: AsyncSession with an open transaction.
+        :return: None
+        '''
+        if not self.rows:
+            return
+        rows = self.take()
+        try:
+            await session.execute(self.statement, rows)
+        except Exception:
+            self.restore(rows)
+            raise
+
+    async def write(self, session_factory: Callable[[], AsyncSession]) -> None:
+        '''
+        Write all buffered rows in their own transaction, so a failure here
+        never rolls back other writes. Rows are restored to the buffer if
+        the insert or the commit fails.
+
+        :param session_factory: Generates AsyncSession for database operations.
+        :return: None
+        '''
+        if not self.rows:
+            return
+        rows = self.take()
+        try:
+            async with session_factory() as session:
+                async with session.begin():
+                    await session.execute(self.statement, rows)
+        except Exception:
+            self.restore(rows)
+            raise